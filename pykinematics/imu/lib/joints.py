@@ -6,16 +6,151 @@ Lukas Adamowicz
 
 V0.1 - March 8, 2019
 """
-from numpy import array, zeros, logical_and, abs as nabs, concatenate, cross, std, sign, argmax, sqrt
-from numpy.linalg import lstsq, norm
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count
+
+from numpy import array, asarray, float64, zeros, empty, arange, einsum, matmul, subtract, negative, minimum, \
+    partition, isnan, dtype as ndtype, abs as nabs, cross, std, sign, argmax, sqrt
+from numpy.linalg import norm
+from scipy.linalg import solve
 from scipy.optimize import least_squares
 
+try:
+    from numba import njit, prange, set_num_threads, config as numba_config
+except ImportError:
+    njit = None
 
 __all__ = ['Center', 'KneeAxis', 'correct_knee', 'fixed_axis']
 
 
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _skew_product(w, wd, K):
+        """
+        Fill K with [w]x[w]x + [wd]x for a single sample.
+        """
+        K[0, 0] = -w[1] * w[1] - w[2] * w[2]
+        K[0, 1] = w[0] * w[1] - wd[2]
+        K[0, 2] = w[0] * w[2] + wd[1]
+        K[1, 0] = w[0] * w[1] + wd[2]
+        K[1, 1] = -w[0] * w[0] - w[2] * w[2]
+        K[1, 2] = w[1] * w[2] - wd[0]
+        K[2, 0] = w[0] * w[2] - wd[1]
+        K[2, 1] = w[1] * w[2] + wd[0]
+        K[2, 2] = -w[0] * w[0] - w[1] * w[1]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _skew_products(w, wd):
+        """
+        Compiled equivalent of Center._compute_skew_products.
+        """
+        K = empty((w.shape[0], 3, 3), dtype=w.dtype)
+        for i in prange(w.shape[0]):
+            _skew_product(w[i], wd[i], K[i])
+        return K
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _sac_normal_equations(pw, dw, pwd, dwd, pa, da, R):
+        """
+        Compute the augmented SAC normal equations [A b]^T [A b] in a single parallel pass over the samples. The
+        per-sample blocks [K_p, -R K_d, b] are never stored, and are accumulated in double precision whatever the
+        input type.
+        """
+        n = pw.shape[0]
+        chunk = 1024  # samples per partial sum, independent of the number of threads for reproducible results
+        n_chunks = (n + chunk - 1) // chunk
+        partial = zeros((n_chunks, 7, 7))
+        for c in prange(n_chunks):
+            C = empty((3, 7))
+            Kd = empty((3, 3))
+            G = partial[c]
+            for i in range(c * chunk, min(n, (c + 1) * chunk)):
+                _skew_product(pw[i], pwd[i], C[:, :3])
+                _skew_product(dw[i], dwd[i], Kd)
+
+                # rotate the distal product and acceleration into the proximal frame
+                for j in range(3):
+                    for k in range(3):
+                        C[j, 3 + k] = -(R[i, j, 0] * Kd[0, k] + R[i, j, 1] * Kd[1, k] + R[i, j, 2] * Kd[2, k])
+                    C[j, 6] = pa[i, j] - (R[i, j, 0] * da[i, 0] + R[i, j, 1] * da[i, 1] + R[i, j, 2] * da[i, 2])
+
+                # upper triangle only, the matrix is symmetric
+                for j in range(7):
+                    for k in range(j, 7):
+                        G[j, k] += C[0, j] * C[0, k] + C[1, j] * C[1, k] + C[2, j] * C[2, k]
+
+        G = partial.sum(axis=0)
+        for j in range(1, 7):
+            for k in range(j):
+                G[j, k] = G[k, j]
+        return G
+
+    @njit(fastmath=True, cache=True)
+    def _tangential_acc(a, K, rx, ry, rz):
+        """
+        Compute a - K @ r for a single sample.
+        """
+        x = a[0] - (K[0, 0] * rx + K[0, 1] * ry + K[0, 2] * rz)
+        y = a[1] - (K[1, 0] * rx + K[1, 1] * ry + K[1, 2] * rz)
+        z = a[2] - (K[2, 0] * rx + K[2, 1] * ry + K[2, 2] * rz)
+        return x, y, z
+
+    @njit(fastmath=True, cache=True)
+    def _tangential_acc_grad(a, K, rx, ry, rz, sgn, out):
+        """
+        Fill out with the gradient of sgn * ||a - K @ r|| with respect to r, -sgn * K^T (a - K @ r) / ||a - K @ r||,
+        for a single sample.
+        """
+        x, y, z = _tangential_acc(a, K, rx, ry, rz)
+        f = -sgn / sqrt(x * x + y * y + z * z)
+
+        out[0] = f * (K[0, 0] * x + K[1, 0] * y + K[2, 0] * z)
+        out[1] = f * (K[0, 1] * x + K[1, 1] * y + K[2, 1] * z)
+        out[2] = f * (K[0, 2] * x + K[1, 2] * y + K[2, 2] * z)
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _ssfc_residuals(r, a1, a2, K1, K2):
+        """
+        Compiled equivalent of Center._compute_distance_residuals, computing the residuals in a single pass over
+        the samples without intermediate arrays.
+        """
+        e = empty(a1.shape[0])
+        for i in prange(a1.shape[0]):
+            x1, y1, z1 = _tangential_acc(a1[i], K1[i], r[0], r[1], r[2])
+            x2, y2, z2 = _tangential_acc(a2[i], K2[i], r[3], r[4], r[5])
+            e[i] = sqrt(x1 * x1 + y1 * y1 + z1 * z1) - sqrt(x2 * x2 + y2 * y2 + z2 * z2)
+        return e
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _ssfc_jacobian(r, a1, a2, K1, K2):
+        """
+        Compiled equivalent of Center._compute_distance_jacobian.
+        """
+        J = empty((a1.shape[0], 6))
+        for i in prange(a1.shape[0]):
+            _tangential_acc_grad(a1[i], K1[i], r[0], r[1], r[2], 1.0, J[i, :3])
+            _tangential_acc_grad(a2[i], K2[i], r[3], r[4], r[5], -1.0, J[i, 3:])
+        return J
+else:
+    _skew_products = None
+    _sac_normal_equations = None
+    _ssfc_residuals = None
+    _ssfc_jacobian = None
+
+
+def _init_batch_worker(n_threads):
+    """
+    Limit the threads used by the compiled kernels in each Center.compute_batch worker process, so that the
+    workers together do not use more threads than there are processors.
+    """
+    if njit is not None:
+        set_num_threads(max(1, min(n_threads, numba_config.NUMBA_NUM_THREADS)))
+
+
 class Center:
-    def __init__(self, g=9.81, method='SAC', mask_input=True, min_samples=1000, mask_data='acc', opt_kwargs=None):
+    def __init__(self, g=9.81, method='SAC', mask_input=True, min_samples=1000, mask_data='acc', opt_kwargs=None,
+                 layout='aos', dtype=float64):
         """
         Estimation of joint centers using kinematic constraints.
 
@@ -33,8 +168,17 @@ class Center:
         mask_data : {'acc', 'gyr'}
             Data to use for masking. Default is acceleration.
         opt_kwargs : dict, optional
-            Optimization key-word arguments. SAC uses numpy.linalg.lstsq.
-            SSFC and SSFCv use scipy.optimize.least_squares.
+            Optimization key-word arguments. SAC solves the linear least squares normal equations directly and
+            ignores them. SSFC and SSFCv use scipy.optimize.least_squares, with the analytic jacobian unless `jac` is
+            provided.
+        layout : {'aos', 'soa'}, optional
+            Memory layout of the inputs to `compute`. 'aos' (array of structures) expects Nx3 data arrays and Nx3x3
+            rotations. 'soa' (structure of arrays) expects 3xN data arrays and 3x3xN rotations, where each component
+            is contiguous in memory, and uses them without a transposing copy. Default is 'aos'.
+        dtype : numpy.dtype, optional
+            Floating point type the inputs are cast to for the computation. Using numpy.float32 halves the memory
+            used by the cast and masked copies of the inputs. The SAC normal equations and the SSFC optimization are
+            still computed in double precision. Default is numpy.float64.
 
         References
         ----------
@@ -56,6 +200,14 @@ class Center:
             self.opt_kwargs = opt_kwargs
         else:
             self.opt_kwargs = {}
+        if layout in ['aos', 'soa']:
+            self.layout = layout
+        else:
+            raise ValueError("Layout must be either 'aos' or 'soa'.")
+        if ndtype(dtype).kind == 'f':
+            self.dtype = dtype
+        else:
+            raise ValueError("dtype must be a floating point type.")
 
     def compute(self, prox_a, dist_a, prox_w, dist_w, prox_wd, dist_wd, R_dist_prox):
         """
@@ -87,99 +239,236 @@ class Center:
             Joint center to distal sensor vector.
         residual : float
             Residual value per sample used from the joint center optimization
+
+        Notes
+        -----
+        If the layout is 'soa', the input arrays are 3xN, and `R_dist_prox` is 3x3xN.
         """
+        prox_a, dist_a = asarray(prox_a, dtype=self.dtype), asarray(dist_a, dtype=self.dtype)
+        prox_w, dist_w = asarray(prox_w, dtype=self.dtype), asarray(dist_w, dtype=self.dtype)
+        prox_wd, dist_wd = asarray(prox_wd, dtype=self.dtype), asarray(dist_wd, dtype=self.dtype)
+        if R_dist_prox is not None:
+            R_dist_prox = asarray(R_dist_prox, dtype=self.dtype)
+
+        if self.layout == 'soa':
+            # views with the samples along the first axis.  The masking magnitudes and the masked gathers read each
+            # component contiguously from the original arrays
+            prox_a, dist_a, prox_w, dist_w, prox_wd, dist_wd = prox_a.T, dist_a.T, prox_w.T, dist_w.T, prox_wd.T, \
+                dist_wd.T
+            if R_dist_prox is not None:
+                R_dist_prox = R_dist_prox.transpose([2, 0, 1])
+
+        if self.mask_input:
+            if self.mask_data == 'acc':
+                prox_data = sqrt(einsum('ni,ni->n', prox_a, prox_a))
+                dist_data = sqrt(einsum('ni,ni->n', dist_a, dist_a))
+                prox_data -= self.g
+                dist_data -= self.g
+                thresh = 1.0
+            elif self.mask_data == 'gyr':
+                prox_data = sqrt(einsum('ni,ni->n', prox_w, prox_w))
+                dist_data = sqrt(einsum('ni,ni->n', dist_w, dist_w))
+                thresh = 2.0
+
+            # samples are used if both sensors exceed the threshold.  Work in place in the proximal buffer
+            data = nabs(prox_data, out=prox_data)
+            minimum(data, nabs(dist_data, out=dist_data), out=data)
+            # partition sorts NaN as the largest value.  Set it to 0, which never passes the threshold, so that gaps
+            # in the data are not counted towards the minimum number of samples
+            data[isnan(data)] = 0.0
+            if data.size < self.min_samples:
+                raise ValueError('Not enough samples or samples with high motion in the trial provided.  '
+                                 'Use another trial')
+
+            # the threshold has to be below the min_samples-th largest value to keep enough samples.  Find that value
+            # once, and step the threshold down in increments of 0.05 without re-masking the data at every step
+            kth = data.size - self.min_samples
+            cutoff = partition(data, kth)[kth]
+            while thresh >= cutoff:
+                thresh -= 0.05
+
+            if (thresh - 0.05) < 0.09:
+                raise ValueError('Not enough samples or samples with high motion in the trial provided.  '
+                                 'Use another trial')
+
+            mask = data > thresh
+        else:
+            mask = zeros(prox_a.shape[0], dtype=bool)
+            mask[:] = True
+
+        # select the masked samples once, instead of indexing the inputs repeatedly
+        pa, da = prox_a[mask], dist_a[mask]
+        pw, dw = prox_w[mask], dist_w[mask]
+        pwd, dwd = prox_wd[mask], dist_wd[mask]
+        n_mask = pa.shape[0]  # number of samples used, without another reduction over the mask
+
         if self.method == 'SAC':
-            if self.mask_input:
-                if self.mask_data == 'acc':
-                    prox_data = norm(prox_a, axis=1) - self.g
-                    dist_data = norm(dist_a, axis=1) - self.g
-                    thresh = 1.0
-                elif self.mask_data == 'gyr':
-                    prox_data = norm(prox_w, axis=1)
-                    dist_data = norm(dist_w, axis=1)
-                    thresh = 2.0
-
-                mask = zeros(prox_data.shape, dtype=bool)
-
-                while mask.sum() < self.min_samples:
-                    mask = logical_and(nabs(prox_data) > thresh, nabs(dist_data) > thresh)
-
-                    thresh -= 0.05
-                    if thresh < 0.09:
-                        raise ValueError('Not enough samples or samples with high motion in the trial provided.  '
-                                         'Use another trial')
+            R = R_dist_prox[mask]
+
+            # accumulate the normal equations of the linear least squares problem A r = b, augmented with b as a
+            # seventh column, without creating the oversized A matrix.  Always accumulated in double precision to
+            # preserve the conditioning of the normal equations.  Use the compiled version if numba is available
+            if _sac_normal_equations is not None:
+                G = _sac_normal_equations(pw, dw, pwd, dwd, pa, da, R)
             else:
-                mask = zeros(prox_a.shape[0], dtype=bool)
-                mask[:] = True
-
-            # create the skew symmetric matrix products
-            prox_K = array([[-prox_w[mask, 1] ** 2 - prox_w[mask, 2] ** 2,
-                             prox_w[mask, 0] * prox_w[mask, 1] - prox_wd[mask, 2],
-                             prox_wd[mask, 1] + prox_w[mask, 0] * prox_w[mask, 2]],
-                            [prox_wd[mask, 2] + prox_w[mask, 0] * prox_w[mask, 1],
-                             -prox_w[mask, 0] ** 2 - prox_w[mask, 2] ** 2,
-                             prox_w[mask, 1] * prox_w[mask, 2] - prox_wd[mask, 0]],
-                            [prox_w[mask, 0] * prox_w[mask, 2] - prox_wd[mask, 1],
-                             prox_wd[mask, 0] + prox_w[mask, 1] * prox_w[mask, 2],
-                             -prox_w[mask, 0] ** 2 - prox_w[mask, 1] ** 2]]).transpose([2, 0, 1])
-
-            dist_K = array([[-dist_w[mask, 1] ** 2 - dist_w[mask, 2] ** 2,
-                             dist_w[mask, 0] * dist_w[mask, 1] - dist_wd[mask, 2],
-                             dist_wd[mask, 1] + dist_w[mask, 0] * dist_w[mask, 2]],
-                            [dist_wd[mask, 2] + dist_w[mask, 0] * dist_w[mask, 1],
-                             -dist_w[mask, 0] ** 2 - dist_w[mask, 2] ** 2,
-                             dist_w[mask, 1] * dist_w[mask, 2] - dist_wd[mask, 0]],
-                            [dist_w[mask, 0] * dist_w[mask, 2] - dist_wd[mask, 1],
-                             dist_wd[mask, 0] + dist_w[mask, 1] * dist_w[mask, 2],
-                             -dist_w[mask, 0] ** 2 - dist_w[mask, 1] ** 2]]).transpose([2, 0, 1])
-
-            # create the oversized A and b matrices
-            A = concatenate((prox_K, -R_dist_prox[mask] @ dist_K), axis=2).reshape((-1, 6))
-            b = (prox_a[mask].reshape((-1, 3, 1))
-                 - R_dist_prox[mask] @ dist_a[mask].reshape((-1, 3, 1))).reshape((-1, 1))
-
-            # solve the linear least squares problem
-            r, residual, _, _ = lstsq(A, b, rcond=None)
-            r.resize((6,))
-            residual = residual[0]
+                prox_K, dist_RK, b = Center._compute_sac_products(pw, dw, pwd, dwd, pa, da, R)
+
+                # gather the per-sample blocks [K_p, -R K_d, b] as double precision rows, and accumulate them with a
+                # single matrix product
+                C = empty((n_mask, 3, 7))
+                C[:, :, :3] = prox_K
+                negative(dist_RK, out=C[:, :, 3:6])
+                C[:, :, 6] = b
+                C = C.reshape((-1, 7))
+                G = C.T @ C
+
+            # solve the linear least squares problem through the 6x6 normal equations.  A^T A is symmetric positive
+            # definite, so use a Cholesky factorization instead of a general LU solve
+            r = solve(G[:6, :6], G[:6, 6], assume_a='pos')
+            # the difference can cancel to slightly below zero for a near perfect fit
+            residual = max(G[6, 6] - G[:6, 6] @ r, 0.0)
 
         elif self.method == 'SSFC':
             r_init = zeros((6,))
 
-            if self.mask_input:
-                if self.mask_data == 'acc':
-                    prox_data = norm(prox_a, axis=1) - self.g
-                    dist_data = norm(dist_a, axis=1) - self.g
-                    thresh = 1.0
-                elif self.mask_data == 'gyr':
-                    prox_data = norm(prox_w, axis=1)
-                    dist_data = norm(dist_w, axis=1)
-                    thresh = 2.0
-
-                mask = zeros(prox_data.shape, dtype=bool)
-
-                while mask.sum() < self.min_samples:
-                    mask = logical_and(nabs(prox_data) > thresh, nabs(dist_data) > thresh)
-
-                    thresh -= 0.05
-                    if thresh < 0.09:
-                        raise ValueError('Not enough samples or samples with high motion in the trial provided.  '
-                                         'Use another trial')
+            # the skew symmetric matrix products do not depend on the joint center locations, so create them once
+            # here instead of in every residual and jacobian evaluation.  Use the compiled versions if numba is
+            # available
+            if _ssfc_residuals is not None:
+                args = (pa, da, _skew_products(pw, pwd), _skew_products(dw, dwd))
+                fun, jac = _ssfc_residuals, _ssfc_jacobian
             else:
-                mask = zeros(prox_a.shape[0], dtype=bool)
-                mask[:] = True
+                # scratch buffers for the tangential accelerations, reused by every evaluation.  The residuals
+                # themselves have to be new arrays, as least_squares keeps those of the last accepted step
+                args = (pa, da, Center._compute_skew_products(pw, pwd), Center._compute_skew_products(dw, dwd),
+                        empty(pa.shape), empty(da.shape))
+                fun, jac = Center._compute_distance_residuals, Center._compute_distance_jacobian
 
-            # create the arguments to be passed to both the residual and jacobian calculation functions
-            args = (prox_a[mask], dist_a[mask], prox_w[mask], dist_w[mask], prox_wd[mask], dist_wd[mask])
+            kwargs = {'jac': jac}
+            kwargs.update(self.opt_kwargs)
 
-            sol = least_squares(Center._compute_distance_residuals, r_init.flatten(), args=args, **self.opt_kwargs)
+            sol = least_squares(fun, r_init.flatten(), args=args, **kwargs)
             r = sol.x
             residual = sol.cost
 
-        return r[:3], r[3:], residual / mask.sum()
+        return r[:3], r[3:], residual / n_mask
+
+    def compute_batch(self, trials, n_jobs=None):
+        """
+        Compute the joint center to sensor vectors for multiple independent trials in parallel.
+
+        Parameters
+        ----------
+        trials : iterable of dict
+            Key-word arguments for :meth:`compute` for each trial.
+        n_jobs : int, optional
+            Number of worker processes to use. Default is None, which, like -1, uses the number of processors on the
+            machine. No more workers than trials are started.
+
+        Returns
+        -------
+        results : list
+            List of (prox_r, dist_r, residual) tuples, as returned by :meth:`compute`, in the order of the trials.
+
+        Notes
+        -----
+        The worker processes are started with the 'spawn' method, as forking a process that has already run the
+        multi-threaded numba kernels can hang. Scripts calling this method therefore need to be protected with an
+        ``if __name__ == '__main__':`` block.
+        """
+        n_cpu = cpu_count() or 1
+        if n_jobs is None or n_jobs == -1:
+            n_workers = n_cpu
+        elif isinstance(n_jobs, int) and n_jobs > 0:
+            n_workers = n_jobs
+        else:
+            raise ValueError("n_jobs must be a positive integer, -1, or None.")
+
+        trials = list(trials)
+        if len(trials) == 0:
+            return []
+        # every worker re-imports the modules on start up, so do not start more than there are trials
+        n_workers = min(n_workers, len(trials))
+        n_threads = n_cpu // n_workers
+
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn'),
+                                 initializer=_init_batch_worker, initargs=(n_threads,)) as executor:
+            futures = [executor.submit(self.compute, **trial) for trial in trials]
+            results = [future.result() for future in futures]
+
+        return results
+
+    @staticmethod
+    def _compute_sac_products(pw, dw, pwd, dwd, pa, da, R):
+        """
+        Compute the per-sample blocks of the SAC linear least squares problem.
+
+        Parameters
+        ----------
+        pw : numpy.ndarray
+            Nx3 array of angular velocities from the proximal sensor.
+        dw : numpy.ndarray
+            Nx3 array of angular velocities from the distal sensor.
+        pwd : numpy.ndarray
+            Nx3 array of angular accelerations from the proximal sensor.
+        dwd : numpy.ndarray
+            Nx3 array of angular accelerations from the distal sensor.
+        pa : numpy.ndarray
+            Nx3 array of accelerations from the proximal sensor.
+        da : numpy.ndarray
+            Nx3 array of accelerations from the distal sensor.
+        R : numpy.ndarray
+            Nx3x3 array of rotations from the distal sensor frame to the proximal sensor frame.
+
+        Returns
+        -------
+        prox_K : numpy.ndarray
+            Nx3x3 array of the proximal skew symmetric matrix products.
+        dist_RK : numpy.ndarray
+            Nx3x3 array of the distal skew symmetric matrix products, rotated into the proximal frame.
+        b : numpy.ndarray
+            Nx3 array of the proximal minus the rotated distal accelerations.
+        """
+        prox_K = Center._compute_skew_products(pw, pwd)
+        dist_RK = einsum('nij,njk->nik', R, Center._compute_skew_products(dw, dwd))
+        b = pa - einsum('nij,nj->ni', R, da)
+
+        return prox_K, dist_RK, b
 
     @staticmethod
-    def _compute_distance_residuals(r, a1, a2, w1, w2, wd1, wd2):
+    def _compute_skew_products(w, wd):
+        """
+        Compute the skew symmetric matrix products relating the joint center vector to the sensor acceleration.
+
+        Parameters
+        ----------
+        w : numpy.ndarray
+            Nx3 array of angular velocities.
+        wd : numpy.ndarray
+            Nx3 array of angular accelerations.
+
+        Returns
+        -------
+        K : numpy.ndarray
+            Nx3x3 array of the matrices [w]x[w]x + [wd]x, such that K @ r = w x (w x r) + wd x r.
+        """
+        # [w]x[w]x = w w^T - (w . w) I
+        K = einsum('ni,nj->nij', w, w)
+        diag = arange(3)
+        K[:, diag, diag] -= einsum('ni,ni->n', w, w)[:, None]
+
+        # add the skew symmetric matrix of the angular acceleration to the off-diagonal entries
+        K[:, 0, 1] -= wd[:, 2]
+        K[:, 0, 2] += wd[:, 1]
+        K[:, 1, 0] += wd[:, 2]
+        K[:, 1, 2] -= wd[:, 0]
+        K[:, 2, 0] -= wd[:, 1]
+        K[:, 2, 1] += wd[:, 0]
+
+        return K
+
+    @staticmethod
+    def _compute_distance_residuals(r, a1, a2, K1, K2, at1=None, at2=None):
         """
             Compute the residuals for the given joint center locations for proximal and distal inertial data
 
@@ -192,27 +481,69 @@ class Center:
                 Nx3 array of accelerations from the proximal sensor.
             a2 : numpy.ndarray
                 Nx3 array of accelerations from the distal sensor.
-            w1 : numpy.ndarray
-                Nx3 array of angular velocities from the proximal sensor.
-            w2 : numpy.ndarray
-                Nx3 array of angular velocities from the distal sensor.
-            wd1 : numpy.ndarray
-                Nx3 array of angular accelerations from the proximal sensor.
-            wd2 : numpy.ndarray
-                Nx3 array of angular accelerations from the distal sensor.
+            K1 : numpy.ndarray
+                Nx3x3 array of skew symmetric matrix products for the proximal sensor.  See
+                Center._compute_skew_products.
+            K2 : numpy.ndarray
+                Nx3x3 array of skew symmetric matrix products for the distal sensor.
+            at1 : numpy.ndarray, optional
+                Nx3 array to store the proximal tangential accelerations in, to avoid allocating it on every call.
+            at2 : numpy.ndarray, optional
+                Nx3 array to store the distal tangential accelerations in.
 
             Returns
             -------
             e : numpy.ndarray
                 Nx1 array of residuals for the given joint center location guess.
             """
-        r1 = r[:3]
-        r2 = r[3:]
+        at1 = subtract(a1, matmul(K1, r[:3], out=at1), out=at1)
+        at2 = subtract(a2, matmul(K2, r[3:], out=at2), out=at2)
+
+        e = sqrt(einsum('ni,ni->n', at1, at1))
+        e -= sqrt(einsum('ni,ni->n', at2, at2))
+        return e
+
+    @staticmethod
+    def _compute_distance_jacobian(r, a1, a2, K1, K2, at1=None, at2=None):
+        """
+        Compute the jacobian of the distance residuals with respect to the joint center locations.
+
+        Parameters
+        ----------
+        r : numpy.ndarray
+            6x1 array of joint center locations.  First three values are proximal location guess, last three values
+            are distal location guess.
+        a1 : numpy.ndarray
+            Nx3 array of accelerations from the proximal sensor.
+        a2 : numpy.ndarray
+            Nx3 array of accelerations from the distal sensor.
+        K1 : numpy.ndarray
+            Nx3x3 array of skew symmetric matrix products for the proximal sensor. See Center._compute_skew_products.
+        K2 : numpy.ndarray
+            Nx3x3 array of skew symmetric matrix products for the distal sensor.
+        at1 : numpy.ndarray, optional
+            Nx3 array to store the proximal tangential accelerations in, to avoid allocating it on every call.
+        at2 : numpy.ndarray, optional
+            Nx3 array to store the distal tangential accelerations in.
+
+        Returns
+        -------
+        J : numpy.ndarray
+            Nx6 array of the partial derivatives of the residuals with respect to the joint center locations.
+        """
+        at1 = subtract(a1, matmul(K1, r[:3], out=at1), out=at1)
+        at2 = subtract(a2, matmul(K2, r[3:], out=at2), out=at2)
+
+        # normalize in place
+        at1 /= norm(at1, axis=1, keepdims=True)
+        at2 /= norm(at2, axis=1, keepdims=True)
 
-        at1 = a1 - cross(w1, cross(w1, r1, axisb=0)) - cross(wd1, r1, axisb=0)
-        at2 = a2 - cross(w2, cross(w2, r2, axisb=0)) - cross(wd2, r2, axisb=0)
+        J = empty((a1.shape[0], 6))
+        # d||a - K r|| / dr = -(a - K r)^T K / ||a - K r||
+        J[:, :3] = -einsum('ni,nij->nj', at1, K1)
+        J[:, 3:] = einsum('ni,nij->nj', at2, K2)
 
-        return norm(at1, axis=1) - norm(at2, axis=1)
+        return J
 
 
 class KneeAxis:
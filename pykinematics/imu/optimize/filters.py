@@ -68,7 +68,7 @@ class UnscentedKalmanFilter:
         """
         # make sure that z is 2D for proper broadcasting
         if z.ndim == 1:
-            z.resize((z.size, 1))
+            z = z.reshape((-1, 1))
 
         # compute the sigma points from the state and state covariance
         Xi, W = UnscentedKalmanFilter.sigma_points(self.x, self.P, **sigma_kwargs)
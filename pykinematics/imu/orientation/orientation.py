@@ -6,7 +6,7 @@ Lukas Adamowicz
 
 V0.1 - March 8, 2019
 """
-from numpy import array, zeros, cross, sqrt, abs as nabs, arccos, sin, mean, identity, sum, outer
+from numpy import array, zeros, einsum, sqrt, abs as nabs, arccos, sin, mean, identity, sum, outer
 from numpy.linalg import norm, inv as np_inv
 
 from pykinematics.imu import utility
@@ -212,6 +212,9 @@ class OrientationComplementaryFilter:
             Nx3 array of magnetic field readings.
         dt : float
             Sampling time.
+        r : numpy.ndarray
+            Vector from the center of rotation to the sensor, used to remove the centripetal acceleration if
+            `acc_corr` is True. Either a 3 element array, or a Nx3 array for a time varying vector.
 
         Attributes
         ----------
@@ -220,7 +223,8 @@ class OrientationComplementaryFilter:
         """
         # store input values
         if self.acc_corr:
-            corr = cross(gyr, cross(gyr, r))
+            # w x (w x r) = w (w . r) - r (w . w), without the intermediate cross product arrays
+            corr = gyr * einsum('...i,...i->...', gyr, r)[:, None] - r * einsum('ni,ni->n', gyr, gyr)[:, None]
             self.a = acc - corr
             # store the acceleration norm since its useful
             self.a_mag = norm(self.a, axis=1)
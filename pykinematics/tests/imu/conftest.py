@@ -1,19 +1,31 @@
 import pytest
-from numpy import array, identity, cos, sin, pi, concatenate
+from numpy import array, identity, cos, sin, pi, concatenate, cross, einsum, zeros, random
 import requests
-from tempfile import TemporaryFile
+import os
+from hashlib import sha256
+from tempfile import gettempdir
+
+
+SAMPLE_DATA_URL = 'https://www.uvm.edu/~rsmcginn/download/sample_data.h5'
 
 
 @pytest.fixture(scope='package')
 def sample_file():
-    tf = TemporaryFile()  # temp file to store data
-    # pull the data from the web
-    data = requests.get('https://www.uvm.edu/~rsmcginn/download/sample_data.h5')
-    tf.write(data.content)
-    data.close()  # close off the connection
+    # cache the data on disk, keyed by the url, so that it is only downloaded once
+    cached = os.path.join(gettempdir(), f'pykinematics_{sha256(SAMPLE_DATA_URL.encode()).hexdigest()[:16]}.h5')
+
+    if not os.path.exists(cached):
+        # pull the data from the web, streaming it to a partial file that is only moved into place when complete
+        with requests.get(SAMPLE_DATA_URL, stream=True) as data:
+            data.raise_for_status()
+            with open(cached + '.part', 'wb') as f:
+                for chunk in data.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        os.replace(cached + '.part', cached)
 
-    yield tf
-    tf.close()  # on teardown close the tempfile
+    f = open(cached, 'rb')
+    yield f
+    f.close()  # on teardown close the file
 
 
 @pytest.fixture
@@ -131,3 +143,29 @@ def R():
     r3 = r1 @ array([[1, 0, 0], [0, cos(t3), -sin(t3)], [0, sin(t2), cos(t3)]]).reshape((-1, 3, 3))
 
     return concatenate((r1, r2, r3), axis=0)
+
+
+@pytest.fixture(scope='module')
+def center_trials():
+    # noise free synthetic trials where the joint center accelerations measured by both sensors agree exactly
+    rng = random.RandomState(5)
+    trials, centers = [], []
+    for prox_r, dist_r in ((array([0.1, -0.05, 0.2]), array([-0.2, 0.1, 0.05])),
+                           (array([-0.08, 0.12, 0.03]), array([0.25, 0.02, -0.06]))):
+        n = 1500
+        prox_w, dist_w = rng.normal(0, 2.5, (n, 3)), rng.normal(0, 2.5, (n, 3))
+        prox_wd, dist_wd = rng.normal(0, 10, (n, 3)), rng.normal(0, 10, (n, 3))
+        dist_a = rng.normal(0, 3, (n, 3)) + array([0, 0, 9.81])
+
+        # rotations about the z-axis from the distal to the proximal sensor frame
+        t = rng.uniform(-pi, pi, n)
+        R = zeros((n, 3, 3))
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1], R[:, 2, 2] = cos(t), -sin(t), sin(t), cos(t), 1.0
+
+        dist_jc = dist_a - cross(dist_w, cross(dist_w, dist_r)) - cross(dist_wd, dist_r)
+        prox_a = einsum('nij,nj->ni', R, dist_jc) + cross(prox_w, cross(prox_w, prox_r)) + cross(prox_wd, prox_r)
+
+        trials.append(dict(prox_a=prox_a, dist_a=dist_a, prox_w=prox_w, dist_w=dist_w, prox_wd=prox_wd,
+                           dist_wd=dist_wd, R_dist_prox=R))
+        centers.append((prox_r, dist_r))
+    return trials, centers
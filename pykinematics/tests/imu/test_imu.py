@@ -2,12 +2,18 @@
 Testing of functions and classes for IMU based estimation of joint kinematics
 """
 import pytest
-from numpy import isclose, random, insert, array, zeros, gradient, random
+import os
+import sys
+import subprocess
+from concurrent.futures import Future
+from numpy import isclose, random, insert, array, zeros, gradient, random, ascontiguousarray, moveaxis, float32, nan, \
+    isfinite, savez, cross
 import h5py
 
 from pykinematics.imu.utility import *
 from pykinematics.imu.orientation import *
 from pykinematics.imu.lib.joints import *
+from pykinematics.imu.lib import joints
 from pykinematics.imu.lib.calibration import *
 from pykinematics.imu.lib.angles import *
 
@@ -89,6 +95,21 @@ class TestImuOrientation:
         assert allclose(q_mimu, array([0.99532435, -0.00598765, 0.09583466, 0.01045504]))
         assert allclose(q_imu, array([0.99529476, -0.00603338, 0.09613962, 0.0104455]))
 
+    @pytest.mark.parametrize('r_shape', ((3,), (50, 3)))
+    def test_complementary_filter_acc_corr(self, r_shape):
+        rng = random.default_rng(0)
+        acc = rng.normal(0, 1, (50, 3)) + array([0, 0, 9.81])
+        gyr = rng.normal(0, 2, (50, 3))
+        mag = rng.normal(0, 1, (50, 3)) + array([0.3, 0, -0.4])
+        r = rng.normal(0, 0.1, r_shape)
+
+        ocf = OrientationComplementaryFilter(acc_corr=True)
+        ocf.run(acc, gyr, mag, 1 / 128, r)
+
+        a = acc - cross(gyr, cross(gyr, r))
+        assert allclose(ocf.a_mag, norm(a, axis=1))
+        assert allclose(ocf.a, a / norm(a, axis=1, keepdims=True))
+
     def test_ssro_error(self):
         with pytest.raises(ValueError) as e_info:
             SSRO(c=1.01)
@@ -125,6 +146,15 @@ class TestImuJoint:
         with pytest.raises(ValueError) as e_info:
             Center(mask_data='not acc or gyr')
 
+    def test_joint_center_bad_layout(self):
+        with pytest.raises(ValueError) as e_info:
+            Center(layout='not aos or soa')
+
+    @pytest.mark.parametrize('dtype', (int, bool, 'U8'))
+    def test_joint_center_bad_dtype(self, dtype):
+        with pytest.raises(ValueError) as e_info:
+            Center(dtype=dtype)
+
     def test_joint_center_not_enough_samples(self, sample_file):
         with h5py.File(sample_file, 'r') as f_:
             acc_lu = f_['Star Calibration']['Lumbar']['Accelerometer'][()]
@@ -205,6 +235,170 @@ class TestImuJoint:
         assert allclose(rlu, array([-0.01771183, -0.10908138,  0.02415292]))
         assert allclose(rrt, array([0.25077565, 0.02290044, 0.05807483]))
 
+    @pytest.mark.parametrize('method', ('SAC', 'SSFC'))
+    def test_joint_center_nan_samples(self, center_trials, method):
+        trial = center_trials[0][0]
+        nan_trial = {key: value.copy() for key, value in trial.items()}
+        nan_trial['prox_a'][::5] = nan  # 300 samples with gaps
+        valid = {key: value[isfinite(nan_trial['prox_a']).all(axis=1)] for key, value in trial.items()}
+
+        jc_comp = Center(method=method, mask_input=True, min_samples=1000, mask_data='acc')
+
+        # samples with gaps are never used, and do not count towards the minimum number of samples
+        r_nan = jc_comp.compute(**nan_trial)
+        r_valid = jc_comp.compute(**valid)
+
+        assert allclose(r_nan[0], r_valid[0])
+        assert allclose(r_nan[1], r_valid[1])
+        assert isclose(r_nan[2], r_valid[2])
+
+        nan_trial['prox_a'][:] = nan
+        with pytest.raises(ValueError) as e_info:
+            jc_comp.compute(**nan_trial)
+
+    def test_joint_center_sac_non_finite(self, center_trials):
+        trial = center_trials[0][0]
+        nan_trial = {key: value.copy() for key, value in trial.items()}
+        nan_trial['prox_wd'][10, 1] = nan
+
+        jc_comp = Center(method='SAC', mask_input=False)
+
+        # without masking, the gap is used, and should not silently give a NaN result
+        with pytest.raises(ValueError) as e_info:
+            jc_comp.compute(**nan_trial)
+
+    @pytest.mark.parametrize('method', ('SAC', 'SSFC'))
+    def test_joint_center_numpy_fallback(self, center_trials, method, monkeypatch):
+        pytest.importorskip('numba')
+        trial = center_trials[0][0]
+        # add noise so that the residuals are not trivially zero
+        trial = dict(trial, prox_a=trial['prox_a'] + random.RandomState(2).normal(0, 0.05, trial['prox_a'].shape))
+        jc_comp = Center(method=method, mask_input=True, min_samples=500, mask_data='gyr')
+
+        r_numba = jc_comp.compute(**trial)
+
+        # the numpy implementations are used when the compiled kernels are not available
+        for kernel in ('_skew_products', '_sac_normal_equations', '_ssfc_residuals', '_ssfc_jacobian'):
+            monkeypatch.setattr(joints, kernel, None)
+        r_numpy = jc_comp.compute(**trial)
+
+        assert allclose(r_numba[0], r_numpy[0])
+        assert allclose(r_numba[1], r_numpy[1])
+        assert isclose(r_numba[2], r_numpy[2])
+
+    @pytest.mark.parametrize('compiled', (False, True))
+    def test_joint_center_distance_jacobian(self, center_trials, compiled):
+        trial = center_trials[0][0]
+        if compiled:
+            pytest.importorskip('numba')
+            fun, jac = joints._ssfc_residuals, joints._ssfc_jacobian
+        else:
+            fun, jac = Center._compute_distance_residuals, Center._compute_distance_jacobian
+
+        args = (trial['prox_a'], trial['dist_a'], Center._compute_skew_products(trial['prox_w'], trial['prox_wd']),
+                Center._compute_skew_products(trial['dist_w'], trial['dist_wd']))
+        r = array([0.05, -0.02, 0.1, -0.1, 0.05, 0.02])
+
+        J = jac(r, *args)
+        # central differences, one column per joint center component
+        h = 1e-6
+        J_num = zeros(J.shape)
+        for i in range(6):
+            dr = zeros(6)
+            dr[i] = h
+            J_num[:, i] = (fun(r + dr, *args) - fun(r - dr, *args)) / (2 * h)
+
+        assert J.shape == (trial['prox_a'].shape[0], 6)
+        assert allclose(J, J_num, rtol=1e-6, atol=1e-6)
+
+    def test_joint_center_compute_batch(self, center_trials):
+        trials, centers = center_trials
+        jc_comp = Center(method='SAC', mask_input=False)
+
+        results = jc_comp.compute_batch(trials, n_jobs=2)
+
+        assert len(results) == len(trials)
+        for (rp, rd, res), (rp_true, rd_true) in zip(results, centers):
+            assert allclose(rp, rp_true)
+            assert allclose(rd, rd_true)
+
+    @pytest.mark.parametrize('n_jobs', (0, -2, 1.5))
+    def test_joint_center_compute_batch_bad_n_jobs(self, center_trials, n_jobs):
+        with pytest.raises(ValueError) as e_info:
+            Center(method='SAC', mask_input=False).compute_batch(center_trials[0], n_jobs=n_jobs)
+
+    @pytest.mark.parametrize('n_jobs', (None, -1, 8))
+    def test_joint_center_compute_batch_workers(self, center_trials, n_jobs, monkeypatch):
+        pools = []
+
+        class SerialExecutor:
+            def __init__(self, **kwargs):
+                pools.append(kwargs)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def submit(self, fn, **kwargs):
+                future = Future()
+                future.set_result(fn(**kwargs))
+                return future
+
+        monkeypatch.setattr(joints, 'ProcessPoolExecutor', SerialExecutor)
+        monkeypatch.setattr(joints, 'cpu_count', lambda: 4)
+
+        trials, centers = center_trials
+        results = Center(method='SAC', mask_input=False).compute_batch(iter(trials), n_jobs=n_jobs)
+
+        # no more workers than trials, and the processors are shared between the workers that are started
+        assert pools[0]['max_workers'] == 2
+        assert pools[0]['initargs'] == (2,)
+        assert len(results) == len(trials)
+
+    def test_joint_center_compute_batch_after_compute(self, center_trials, tmp_path):
+        # run in a separate interpreter, as a hang from forking after the multi-threaded compiled kernels have run
+        # only shows up when the interpreter exits
+        trial = center_trials[0][0]
+        savez(tmp_path / 'trial.npz', **trial)
+        script = tmp_path / 'batch.py'
+        script.write_text(
+            "from numpy import load\n"
+            "from pykinematics.imu.lib.joints import Center\n"
+            "if __name__ == '__main__':\n"
+            f"    trial = dict(load(r'{tmp_path / 'trial.npz'}'))\n"
+            "    jc_comp = Center(method='SAC', mask_input=False)\n"
+            "    jc_comp.compute(**trial)\n"
+            "    jc_comp.compute_batch([trial, trial], n_jobs=2)\n"
+        )
+
+        proc = subprocess.run([sys.executable, str(script)], timeout=120, cwd=os.getcwd(),
+                              env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        assert proc.returncode == 0
+
+    @pytest.mark.parametrize('method', ('SAC', 'SSFC'))
+    def test_joint_center_soa_layout(self, center_trials, method):
+        trial = center_trials[0][0]
+        soa_trial = {key: ascontiguousarray(moveaxis(value, 0, -1)) for key, value in trial.items()}
+
+        aos = Center(method=method, min_samples=500, mask_data='gyr', layout='aos').compute(**trial)
+        soa = Center(method=method, min_samples=500, mask_data='gyr', layout='soa').compute(**soa_trial)
+
+        assert allclose(aos[0], soa[0])
+        assert allclose(aos[1], soa[1])
+        assert isclose(aos[2], soa[2])
+
+    @pytest.mark.parametrize('method', ('SAC', 'SSFC'))
+    def test_joint_center_float32(self, center_trials, method):
+        trial = center_trials[0][0]
+
+        r64 = Center(method=method, min_samples=500, mask_data='gyr').compute(**trial)
+        r32 = Center(method=method, min_samples=500, mask_data='gyr', dtype=float32).compute(**trial)
+
+        assert allclose(r64[0], r32[0], atol=1e-4)
+        assert allclose(r64[1], r32[1], atol=1e-4)
+
     @pytest.mark.integration
     def test_knee_axis(self, sample_file):
         with h5py.File(sample_file, 'r') as f_: